@@ -0,0 +1,82 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+ADMITTED = "admitted"
+RATE_LIMITED = "rateLimited"
+OVERLOADED = "overloaded"
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        # returns 0 if a token was taken, otherwise seconds until one is available
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class AdmissionControl:
+    """Per-client token buckets plus a global cap on requests in flight.
+
+    A rate or maxInFlight of 0 disables that check; burst must be at least 1.
+    """
+
+    def __init__(self, rate=0, burst=1, maxInFlight=0, maxClients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.maxInFlight = maxInFlight
+        self.maxClients = maxClients
+        # least recently seen client first, so the idlest bucket is evicted when full
+        self.buckets = OrderedDict()
+        self.inFlight = 0
+        self.counters = {ADMITTED: 0, RATE_LIMITED: 0, OVERLOADED: 0}
+        self.lock = threading.Lock()
+
+    def admit(self, client):
+        """Returns (outcome, retryAfter); call release() after an admitted request."""
+        with self.lock:
+            # check the in-flight cap first so a shed request doesn't cost the client a token
+            if self.maxInFlight and self.inFlight >= self.maxInFlight:
+                self.counters[OVERLOADED] += 1
+                return (OVERLOADED, 1)
+            if self.rate:
+                bucket = self.buckets.get(client)
+                if bucket is None:
+                    if len(self.buckets) >= self.maxClients:
+                        self.buckets.popitem(last=False)
+                    bucket = self.buckets[client] = TokenBucket(self.rate, self.burst)
+                else:
+                    self.buckets.move_to_end(client)
+                wait = bucket.take()
+                if wait:
+                    self.counters[RATE_LIMITED] += 1
+                    return (RATE_LIMITED, max(1, math.ceil(wait)))
+            self.inFlight += 1
+            self.counters[ADMITTED] += 1
+            return (ADMITTED, 0)
+
+    def release(self):
+        with self.lock:
+            self.inFlight -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "limits": {
+                    "rate": self.rate,
+                    "burst": self.burst,
+                    "maxInFlight": self.maxInFlight,
+                },
+                "inFlight": self.inFlight,
+                "counters": dict(self.counters),
+            }
@@ -1,4 +1,18 @@
+import os
 import sqlite3
+import time
+from pathlib import Path
+from contextlib import closing
+
+DEFAULT_DB_PATH = "squirrel_db.db"
+MEMORY_DB_URI = "file:squirrel_db_memory?mode=memory&cache=shared"
+
+# A shared in-memory database only lives while a connection to it is open,
+# so the anchor connection and the pristine snapshot are held for the
+# lifetime of the process. Callers serialize access to them, so they may be
+# used from any thread.
+_memoryAnchor = None
+_memorySnapshot = None
 
 def dict_factory(cursor, row):
     d = {}
@@ -6,36 +20,81 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
+def loadMemoryDB(templatePath):
+    global _memoryAnchor, _memorySnapshot
+    # sqlite would otherwise create a missing template as an empty database
+    if not os.path.isfile(templatePath):
+        raise FileNotFoundError(f"template database not found: {templatePath}")
+    templateUri = Path(templatePath).resolve().as_uri() + "?mode=ro"
+    snapshot = sqlite3.connect(":memory:", check_same_thread=False)
+    with closing(sqlite3.connect(templateUri, uri=True)) as template:
+        template.backup(snapshot)
+    if _memoryAnchor is None:
+        _memoryAnchor = sqlite3.connect(MEMORY_DB_URI, uri=True, check_same_thread=False)
+    _memorySnapshot = snapshot
+    resetMemoryDB()
+
+def resetMemoryDB():
+    _memorySnapshot.backup(_memoryAnchor)
+
 class SquirrelDB:
 
-    def __init__(self):
-        self.connection = sqlite3.connect("squirrel_db.db")
+    def __init__(self, dbPath=DEFAULT_DB_PATH, inMemory=False, trace=None):
+        # when given a list, each statement run is appended to it as (sql, seconds)
+        self.trace = trace
+        if inMemory:
+            if _memorySnapshot is None:
+                loadMemoryDB(dbPath)
+            self.connection = sqlite3.connect(MEMORY_DB_URI, uri=True)
+        else:
+            self.connection = sqlite3.connect(dbPath)
         self.connection.row_factory = dict_factory
         self.cursor = self.connection.cursor()
 
+    def close(self):
+        self.connection.close()
+
+    def execute(self, sql, data=()):
+        if self.trace is None:
+            return self.cursor.execute(sql, data)
+        start = time.perf_counter()
+        try:
+            return self.cursor.execute(sql, data)
+        finally:
+            self.trace.append((sql, time.perf_counter() - start))
+
+    def commit(self):
+        if self.trace is None:
+            return self.connection.commit()
+        start = time.perf_counter()
+        try:
+            return self.connection.commit()
+        finally:
+            self.trace.append(("COMMIT", time.perf_counter() - start))
+
     def getSquirrels(self):
-        self.cursor.execute("SELECT * FROM squirrels ORDER BY id")
+        self.execute("SELECT * FROM squirrels ORDER BY id")
         return self.cursor.fetchall()
 
     def getSquirrel(self, squirrelId):
         data = [squirrelId]
-        self.cursor.execute("SELECT * FROM squirrels WHERE id = ?", data)
+        self.execute("SELECT * FROM squirrels WHERE id = ?", data)
         return self.cursor.fetchone()
 
     def createSquirrel(self, name, size):
         data = [name, size]
-        self.cursor.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", data)
-        self.connection.commit()
+        self.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", data)
+        self.commit()
         return None
 
     def updateSquirrel(self, squirrelId, name, size):
         data = [name, size, squirrelId]
-        self.cursor.execute("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", data)
-        self.connection.commit()
+        self.execute("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", data)
+        self.commit()
         return None
 
     def deleteSquirrel(self, squirrelId):
         data = [squirrelId]
-        self.cursor.execute("DELETE FROM squirrels WHERE id = ?", data)
-        self.connection.commit()
+        self.execute("DELETE FROM squirrels WHERE id = ?", data)
+        self.commit()
         return None
@@ -0,0 +1,72 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+class SamplingProfiler:
+    """Samples the stacks of every thread in the process for a fixed time.
+
+    Results are written in collapsed-stack ("folded") format, one
+    "thread;outer;...;inner count" line per distinct stack, which
+    flamegraph.pl, speedscope and similar tools read directly.
+    """
+
+    def __init__(self, outputDir=".", interval=0.01):
+        self.outputDir = outputDir
+        self.interval = interval
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def checkOutputDir(self):
+        if not os.path.isdir(self.outputDir):
+            raise FileNotFoundError(f"profile directory not found: {self.outputDir}")
+        if not os.access(self.outputDir, os.W_OK):
+            raise PermissionError(f"profile directory not writable: {self.outputDir}")
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds):
+        """Starts sampling in the background and returns the output path, or None if already running.
+
+        The output file is created (as path + ".part") before sampling starts,
+        so an unwritable directory raises OSError here rather than in the
+        background thread. It is renamed to path once complete, so readers
+        never see a partial profile.
+        """
+        with self.lock:
+            if self.isRunning():
+                return None
+            now = time.time()
+            name = time.strftime("squirrel_profile_%Y%m%d_%H%M%S", time.localtime(now))
+            name += f"_{int(now * 1000) % 1000:03d}.folded"
+            path = os.path.join(self.outputDir, name)
+            f = open(path + ".part", "w")
+            self.thread = threading.Thread(target=self.run, args=(seconds, f, path), daemon=True)
+            self.thread.start()
+            return path
+
+    def run(self, seconds, f, path):
+        stacks = Counter()
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    stacks[self.foldStack(names.get(ident, str(ident)), frame)] += 1
+            time.sleep(self.interval)
+        with f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        os.replace(f.name, path)
+
+    def foldStack(self, threadName, frame):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        frames.append(threadName)
+        return ";".join(reversed(frames))
@@ -1,34 +1,75 @@
 import sys
 import json
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import math
+import time
+import signal
+import argparse
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import parse_qs
-from squirrel_db import SquirrelDB
+from squirrel_db import SquirrelDB, DEFAULT_DB_PATH, resetMemoryDB
+from squirrel_admission import AdmissionControl, ADMITTED, RATE_LIMITED
+from squirrel_profiling import SamplingProfiler
+
+DEFAULT_PROFILE_SECONDS = 10
+MAX_PROFILE_SECONDS = 300
+REQUEST_TIMEOUT = 10
+MAX_DISCARD_BYTES = 8192
+DEFAULT_BACKLOG = 1024
 
 class SquirrelServerHandler(BaseHTTPRequestHandler):
 
+    # seconds a socket read or write may stall before the connection is dropped
+    timeout = REQUEST_TIMEOUT
+
+    # per-request bookkeeping for the slow-request log
+    sqlTrace = None
+    responseSize = 0
+
     # HTTP METHODS
 
     def do_GET(self):
+        self.dispatch(self.routeGET)
+
+    def do_POST(self):
+        self.dispatch(self.routePOST)
+
+    def do_PUT(self):
+        self.dispatch(self.routePUT)
+
+    def do_DELETE(self):
+        self.dispatch(self.routeDELETE)
+
+    # ROUTES
+
+    def routeGET(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
             if resourceId:
                 self.handleSquirrelsRetrieve(resourceId)
             else:
                 self.handleSquirrelsIndex()
+        elif resourceName == "admin" and resourceId == "stats":
+            self.handleAdminStats()
         else:
             self.handle404()
 
-    def do_POST(self):
+    def routePOST(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
             if resourceId:
                 self.handle404()
             else:
                 self.handleSquirrelsCreate()
+        elif resourceName == "admin" and resourceId == "reset":
+            self.handleAdminReset()
+        elif resourceName == "admin" and resourceId == "profile":
+            self.handleAdminProfile()
         else:
             self.handle404()
 
-    def do_PUT(self):
+    def routePUT(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
             if resourceId:
@@ -38,7 +79,7 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
         else:
             self.handle404()
 
-    def do_DELETE(self):
+    def routeDELETE(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
             if resourceId:
@@ -50,6 +91,77 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
 
     # HELPERS
 
+    def dispatch(self, route):
+        try:
+            self.timeRoute(route)
+        except TimeoutError:
+            self.log_error("request timed out")
+            self.close_connection = True
+
+    def timeRoute(self, route):
+        if self.server.slowSeconds is None:
+            self.admitAndRoute(route)
+            return
+        self.sqlTrace = []
+        self.responseSize = 0
+        start = time.perf_counter()
+        try:
+            self.admitAndRoute(route)
+        finally:
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.server.slowSeconds:
+                self.logSlowRequest(elapsed)
+
+    def admitAndRoute(self, route):
+        # admin requests skip admission control so operators can still get in under overload
+        if self.isAdmin():
+            route()
+            return
+        outcome, retryAfter = self.server.admission.admit(self.client_address[0])
+        if outcome != ADMITTED:
+            self.discardRequestBody()
+            if outcome == RATE_LIMITED:
+                self.handle429(retryAfter)
+            else:
+                self.handle503(retryAfter)
+            return
+        try:
+            route()
+        finally:
+            self.server.admission.release()
+
+    def logSlowRequest(self, elapsed):
+        # one write per request, so records from concurrent requests can't
+        # interleave their sql lines; log_message would escape the newlines,
+        # so the client-supplied path is escaped here instead
+        path = self.path.encode("unicode_escape").decode("ascii")
+        record = (f"{self.address_string()} - - [{self.log_date_time_string()}] slow request: "
+                  f"{self.command} {path} {elapsed * 1000:.1f}ms {self.responseSize} bytes\n")
+        for sql, seconds in self.sqlTrace:
+            record += f"  sql {seconds * 1000:.1f}ms {sql}\n"
+        sys.stderr.write(record)
+
+    @contextmanager
+    def openDB(self):
+        # requests run concurrently so overload can be shed early, but SQLite
+        # access stays serialized; hold the lock only while the database is
+        # open, never while reading the request or writing the response
+        with self.server.dbLock:
+            db = SquirrelDB(self.server.dbPath, inMemory=self.server.inMemory, trace=self.sqlTrace)
+            try:
+                yield db
+            finally:
+                db.close()
+
+    def sendBody(self, text):
+        body = bytes(text, "utf-8")
+        self.responseSize += len(body)
+        self.wfile.write(body)
+
+    def isAdmin(self):
+        token = self.server.adminToken
+        return token is not None and self.headers.get("X-Admin-Token") == token
+
     def getRequestData(self):
         length = int(self.headers["Content-Length"])
         body = self.rfile.read(length).decode("utf-8")
@@ -58,6 +170,20 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
             data[key] = data[key][0]
         return data
 
+    def discardRequestBody(self):
+        # closing with an unread body can reset the connection before the client
+        # sees our response, so drain small bodies; anything large or malformed
+        # isn't worth a thread's time and the connection is just dropped
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if 0 <= length <= MAX_DISCARD_BYTES:
+            if length:
+                self.rfile.read(length)
+        else:
+            self.close_connection = True
+
     def parsePath(self):
         if self.path.startswith("/"):
             parts = self.path[1:].split("/")
@@ -71,75 +197,225 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
     # ACTIONS
 
     def handleSquirrelsIndex(self):
-        db = SquirrelDB()
-        squirrelsList = db.getSquirrels()
+        with self.openDB() as db:
+            squirrelsList = db.getSquirrels()
         self.send_response(200)
         self.send_header("Content-Type", "application/json")
         self.end_headers()
-        self.wfile.write(bytes(json.dumps(squirrelsList), "utf-8"))
+        self.sendBody(json.dumps(squirrelsList))
 
     def handleSquirrelsRetrieve(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
+        with self.openDB() as db:
+            squirrel = db.getSquirrel(squirrelId)
         if squirrel:
             self.send_response(200)
             self.send_header("Content-Type", "application/json")
             self.end_headers()
-            self.wfile.write(bytes(json.dumps(squirrel), "utf-8"))
+            self.sendBody(json.dumps(squirrel))
         else:
             self.handle404()
 
     def handleSquirrelsCreate(self):
-        db = SquirrelDB()
         body = self.getRequestData()
-        db.createSquirrel(body["name"], body["size"])
+        with self.openDB() as db:
+            db.createSquirrel(body["name"], body["size"])
         self.send_response(201)
         self.end_headers()
 
     def handleSquirrelsUpdate(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
+        with self.openDB() as db:
+            squirrel = db.getSquirrel(squirrelId)
         if squirrel:
+            # read the body outside the lock so a slow client doesn't hold the database
             body = self.getRequestData()
-            db.updateSquirrel(squirrelId, body["name"], body["size"])
+            with self.openDB() as db:
+                db.updateSquirrel(squirrelId, body["name"], body["size"])
             self.send_response(204)
             self.end_headers()
         else:
             self.handle404()
 
     def handleSquirrelsDelete(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
+        with self.openDB() as db:
+            squirrel = db.getSquirrel(squirrelId)
+            if squirrel:
+                db.deleteSquirrel(squirrelId)
         if squirrel:
-            db.deleteSquirrel(squirrelId)
             self.send_response(204)
             self.end_headers()
         else:
             self.handle404()
 
+    def handleAdminReset(self):
+        # only available when serving from the in-memory snapshot
+        if not self.server.inMemory:
+            self.handle404()
+        elif not self.isAdmin():
+            self.handle403()
+        else:
+            with self.server.dbLock:
+                resetMemoryDB()
+            self.send_response(204)
+            self.end_headers()
+
+    def handleAdminStats(self):
+        if not self.isAdmin():
+            self.handle403()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.sendBody(json.dumps(self.server.admission.stats()))
+
+    def handleAdminProfile(self):
+        if not self.isAdmin():
+            self.handle403()
+            return
+        seconds = DEFAULT_PROFILE_SECONDS
+        if self.headers.get("Content-Length"):
+            body = self.getRequestData()
+            try:
+                seconds = float(body.get("seconds", seconds))
+            except ValueError:
+                seconds = 0
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            self.handle400(f"seconds must be between 0 and {MAX_PROFILE_SECONDS}")
+            return
+        try:
+            path = self.server.profiler.start(seconds)
+        except OSError as e:
+            self.handle500(f"could not start profile: {e}")
+            return
+        if path is None:
+            self.send_response(409)
+            self.send_header("Content-Type", "text/plain")
+            self.end_headers()
+            self.sendBody("409 Profile Already Running")
+            return
+        self.send_response(202)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.sendBody(json.dumps({"path": path, "seconds": seconds}))
+
+    def handle400(self, message):
+        self.send_response(400)
+        self.send_header("Content-Type", "text/plain")
+        self.end_headers()
+        self.sendBody(f"400 Bad Request: {message}")
+
+    def handle500(self, message):
+        self.send_response(500)
+        self.send_header("Content-Type", "text/plain")
+        self.end_headers()
+        self.sendBody(f"500 Internal Server Error: {message}")
+
+    def handle403(self):
+        self.send_response(403)
+        self.send_header("Content-Type", "text/plain")
+        self.end_headers()
+        self.sendBody("403 Forbidden")
+
     def handle404(self):
         self.send_response(404)
         self.send_header("Content-Type", "text/plain")
         self.end_headers()
-        self.wfile.write(bytes("404 Not Found", "utf-8"))
+        self.sendBody("404 Not Found")
+
+    def handle429(self, retryAfter):
+        self.send_response(429)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Retry-After", str(retryAfter))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.sendBody("429 Too Many Requests")
+
+    def handle503(self, retryAfter):
+        self.send_response(503)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Retry-After", str(retryAfter))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.sendBody("503 Service Unavailable")
+
+class SquirrelHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer with a configurable listen backlog.
+
+    socketserver's default backlog of 5 overflows under bursts, so clients see
+    connection errors and SYN retransmits before admission control can answer
+    them with 429/503.
+    """
 
-def run(port=8080):
-    print(f"squirrel_server running at 127.0.0.1:{port}")
+    def __init__(self, listen, handlerClass, backlog=DEFAULT_BACKLOG):
+        self.request_queue_size = backlog
+        super().__init__(listen, handlerClass)
+
+def run(port=8080, dbPath=DEFAULT_DB_PATH, inMemory=False, adminToken=None,
+        rate=0, burst=1, maxInFlight=0, slowMs=None, profileDir=".", backlog=DEFAULT_BACKLOG):
+    # port 0 lets the OS pick a free port; the bound port is printed below
     listen = ("127.0.0.1", port)
-    server = HTTPServer(listen, SquirrelServerHandler)
+    server = SquirrelHTTPServer(listen, SquirrelServerHandler, backlog)
+    server.dbPath = dbPath
+    server.inMemory = inMemory
+    server.adminToken = adminToken
+    server.dbLock = threading.Lock()
+    server.admission = AdmissionControl(rate, burst, maxInFlight)
+    server.slowSeconds = None if slowMs is None else slowMs / 1000
+    server.profiler = SamplingProfiler(profileDir)
+    server.profiler.checkOutputDir()
+    if hasattr(signal, "SIGUSR1"):
+        def profileOnSignal(signum, frame):
+            # an exception here would surface in serve_forever and stop the server
+            try:
+                server.profiler.start(DEFAULT_PROFILE_SECONDS)
+            except OSError as e:
+                print(f"could not start profile: {e}", file=sys.stderr)
+        signal.signal(signal.SIGUSR1, profileOnSignal)
+    if inMemory:
+        # load the snapshot before serving so the first request doesn't pay for it
+        SquirrelDB(dbPath, inMemory=True).close()
+    port = server.server_address[1]
+    print(f"squirrel_server running at 127.0.0.1:{port}", flush=True)
     server.serve_forever()
 
 if __name__ == '__main__':
-    port = 8080  # default
-
-    if len(sys.argv) > 1:
-        try:
-            port = int(sys.argv[1])
-        except ValueError:
-            print("Port must be an integer.")
-            sys.exit(1)
+    parser = argparse.ArgumentParser(description="Run the squirrel server.")
+    parser.add_argument("port", nargs="?", type=int, default=8080,
+                        help="port to listen on, 0 picks a free port (default 8080)")
+    parser.add_argument("dbPath", nargs="?", default=DEFAULT_DB_PATH,
+                        help=f"SQLite database file (default {DEFAULT_DB_PATH})")
+    parser.add_argument("--memory", action="store_true",
+                        help="serve from a shared in-memory copy of dbPath; changes are not saved")
+    parser.add_argument("--admin-token", default=None,
+                        help="token required in X-Admin-Token for /admin routes")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="requests per second allowed per client, 0 for no limit (default 0)")
+    parser.add_argument("--burst", type=int, default=1,
+                        help="requests a client may make at once before --rate applies (default 1)")
+    parser.add_argument("--max-in-flight", type=int, default=0,
+                        help="requests handled at once before shedding with 503, 0 for no limit (default 0)")
+    parser.add_argument("--backlog", type=int, default=DEFAULT_BACKLOG,
+                        help=f"connections the kernel queues before they are accepted (default {DEFAULT_BACKLOG})")
+    parser.add_argument("--slow-ms", type=float, default=None,
+                        help="log requests slower than this many milliseconds with their SQL timings")
+    parser.add_argument("--profile-dir", default=".",
+                        help="where POST /admin/profile and SIGUSR1 write profiles (default .)")
+    args = parser.parse_args()
+    if not (args.rate >= 0 and math.isfinite(args.rate)):
+        parser.error("--rate must be a non-negative number")
+    if args.burst < 1:
+        parser.error("--burst must be at least 1")
+    if args.max_in_flight < 0:
+        parser.error("--max-in-flight must not be negative")
+    if args.backlog < 1:
+        parser.error("--backlog must be at least 1")
 
     try:
-        run(port)
+        run(args.port, args.dbPath, inMemory=args.memory, adminToken=args.admin_token,
+            rate=args.rate, burst=args.burst, maxInFlight=args.max_in_flight,
+            slowMs=args.slow_ms, profileDir=args.profile_dir, backlog=args.backlog)
+    except (FileNotFoundError, PermissionError) as e:
+        parser.exit(1, f"{e}\n")
     except KeyboardInterrupt:
         print("ur done")
@@ -1,15 +1,45 @@
 import os
 import shutil
+import socket
 import subprocess
 import time
 import requests
 import pytest
-import socket
 # import sys
 
 
 # store chosen port for other fixtures
 CONFIGURED_PORT = None
+ADMIN_TOKEN = "test-admin-token"
+
+
+def start_server(*options, db_path="empty_squirrel_db.db", memory=True):
+    """Start a squirrel server on a free port and return (process, port)"""
+
+    # By default serve from an in-memory copy of the empty template so each
+    # session (or xdist worker) has its own database and resets don't touch
+    # disk. Port 0 lets the OS pick a free port.
+    if memory:
+        options = ("--memory", *options)
+    process = subprocess.Popen(
+        ["python3", "squirrel_server.py", "0", db_path,
+         "--admin-token", ADMIN_TOKEN, *options],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+
+    # Wait for server to start and read back the port it bound
+    line = process.stdout.readline()
+    if not line:
+        process.terminate()
+        raise Exception("Error: squirrel server did not start.")
+    return process, int(line.strip().rsplit(":", 1)[1])
+
+
+def stop_server(process):
+    process.terminate()
+    process.wait()
 
 
 @pytest.fixture(scope="session")
@@ -18,44 +48,71 @@ def server_process():
 
     global CONFIGURED_PORT
 
-    # Reset database to clean state
-    shutil.copy("empty_squirrel_db.db", "squirrel_db.db")
+    process, CONFIGURED_PORT = start_server()
 
-    # Decide port: try 8080 → fallback 8090
-    chosen_port = 8080
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    yield process
 
-    try:
-        s.bind(("0.0.0.0", chosen_port))
-    except socket.error:
-        print('8080 Socket is already open')
-        chosen_port = 8090
-        try:
-            s.bind(("0.0.0.0", chosen_port))
-        except socket.error:
-            raise Exception("Error: No available port (8080 or 8090).")
-    finally:
-        s.close()
+    # Cleanup
+    stop_server(process)
 
-    CONFIGURED_PORT = chosen_port
 
-    # Start server on that port
-    process = subprocess.Popen(
-        ["python3", "squirrel_server.py", str(chosen_port)],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
+@pytest.fixture
+def file_server_url(tmp_path):
+    """Start a server backed by a copy of the template file in tmp_path"""
+    db_path = tmp_path / "squirrel_db.db"
+    shutil.copy("empty_squirrel_db.db", db_path)
+    process, port = start_server(db_path=str(db_path), memory=False)
+    yield f"http://127.0.0.1:{port}"
+    stop_server(process)
 
-    # Wait for server to start
-    time.sleep(1)
 
-    yield process
+@pytest.fixture
+def limited_server_url():
+    """Start a server with tight admission limits for a single test"""
+    process, port = start_server("--rate", "1", "--burst", "2", "--max-in-flight", "1")
+    yield f"http://127.0.0.1:{port}"
+    stop_server(process)
 
-    # Cleanup
-    process.terminate()
-    process.wait()
-    if os.path.exists("squirrel_db.db"):
-        os.remove("squirrel_db.db")
+
+@pytest.fixture
+def traced_server(tmp_path):
+    """Start a server that logs every request as slow and profiles into tmp_path"""
+    process, port = start_server("--slow-ms", "0", "--profile-dir", str(tmp_path))
+    yield process, f"http://127.0.0.1:{port}"
+    stop_server(process)
+
+
+def wait_until(predicate, timeout=5):
+    """Poll predicate until it returns something truthy or the deadline passes"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.02)
+    raise AssertionError("timed out waiting for condition")
+
+
+def in_flight(url):
+    """Read the number of requests in flight from /admin/stats"""
+    return requests.get(f"{url}/admin/stats", headers={"X-Admin-Token": ADMIN_TOKEN}).json()["inFlight"]
+
+
+def send_raw_request(url, headers):
+    """Send a raw request with no body and return the response head"""
+    host, port = url.rsplit("/", 1)[1].split(":")
+    with socket.create_connection((host, int(port)), timeout=2) as sock:
+        sock.sendall(headers)
+        return sock.recv(4096).decode("iso-8859-1")
+
+
+def send_stalled_post(url):
+    """Open a POST that promises a body it never sends, keeping one request in flight"""
+    host, port = url.rsplit("/", 1)[1].split(":")
+    sock = socket.create_connection((host, int(port)))
+    sock.sendall(b"POST /squirrels HTTP/1.1\r\nHost: x\r\nContent-Length: 100\r\n\r\n")
+    wait_until(lambda: in_flight(url) >= 1)
+    return sock
 
 
 @pytest.fixture
@@ -66,9 +123,10 @@ def base_url():
 
 
 @pytest.fixture(scope="function")
-def clean_database():
+def clean_database(server_process, base_url):
     """Reset database to clean state for each test"""
-    shutil.copy("empty_squirrel_db.db", "squirrel_db.db")
+    response = requests.post(f"{base_url}/admin/reset", headers={"X-Admin-Token": ADMIN_TOKEN})
+    assert response.status_code == 204
 
 
 def describe_SquirrelServer():
@@ -189,6 +247,12 @@ def describe_SquirrelServer():
             assert squirrel["name"] == "Updated"
             assert squirrel["size"] == "large"
         
+        def it_returns_404_when_updating_nonexistent_squirrel_without_body(server_process, base_url, clean_database):
+            """Test 404 for PUT to a missing id that sends no Content-Length"""
+            head = send_raw_request(base_url, b"PUT /squirrels/999 HTTP/1.1\r\nHost: x\r\n\r\n")
+
+            assert head.startswith("HTTP/1.0 404")
+
         def it_returns_404_when_updating_nonexistent_squirrel(server_process, base_url, clean_database):
             """Test 404 response when updating non-existent squirrel"""
             response = requests.put(f"{base_url}/squirrels/999", data={"name": "Test", "size": "medium"})
@@ -352,4 +416,330 @@ def describe_SquirrelServer():
             
             # Verify first squirrel is gone
             first_response = requests.get(f"{base_url}/squirrels/1")
-            assert first_response.status_code == 404
\ No newline at end of file
+            assert first_response.status_code == 404
+
+    def describe_file_backed_mode():
+        """Test a server running directly against a database file"""
+
+        def it_reads_back_created_squirrels(file_server_url):
+            """Test a create/read round-trip against the file"""
+            requests.post(f"{file_server_url}/squirrels", data={"name": "Fluffy", "size": "large"})
+
+            response = requests.get(f"{file_server_url}/squirrels/1")
+
+            assert response.json() == {"id": 1, "name": "Fluffy", "size": "large"}
+
+        def it_returns_404_for_admin_reset(file_server_url):
+            """Test that the reset route only exists in memory mode"""
+            response = requests.post(f"{file_server_url}/admin/reset", headers={"X-Admin-Token": ADMIN_TOKEN})
+
+            assert response.status_code == 404
+
+        def it_refuses_to_start_from_a_missing_template(tmp_path):
+            """Test that --memory with a missing template exits without creating the file"""
+            db_path = tmp_path / "missing.db"
+
+            result = subprocess.run(
+                ["python3", "squirrel_server.py", "0", str(db_path), "--memory"],
+                capture_output=True, text=True, timeout=10
+            )
+
+            assert result.returncode == 1
+            assert not db_path.exists()
+
+    def describe_POST_admin_reset():
+        """Test POST /admin/reset endpoint"""
+
+        def it_restores_the_empty_snapshot(server_process, base_url, clean_database):
+            """Test that reset discards created squirrels"""
+            requests.post(f"{base_url}/squirrels", data={"name": "Fluffy", "size": "large"})
+
+            response = requests.post(f"{base_url}/admin/reset", headers={"X-Admin-Token": ADMIN_TOKEN})
+
+            assert response.status_code == 204
+            assert requests.get(f"{base_url}/squirrels").json() == []
+
+        def it_restarts_ids_after_reset(server_process, base_url, clean_database):
+            """Test that ids start from 1 again after reset"""
+            requests.post(f"{base_url}/squirrels", data={"name": "First", "size": "small"})
+            requests.post(f"{base_url}/admin/reset", headers={"X-Admin-Token": ADMIN_TOKEN})
+            requests.post(f"{base_url}/squirrels", data={"name": "Second", "size": "small"})
+
+            response = requests.get(f"{base_url}/squirrels/1")
+
+            assert response.json()["name"] == "Second"
+
+        def it_returns_403_without_admin_token(server_process, base_url, clean_database):
+            """Test 403 when the admin token header is missing"""
+            response = requests.post(f"{base_url}/admin/reset")
+
+            assert response.status_code == 403
+            assert response.text == "403 Forbidden"
+
+        def it_returns_403_with_wrong_admin_token(server_process, base_url, clean_database):
+            """Test 403 when the admin token is wrong"""
+            response = requests.post(f"{base_url}/admin/reset", headers={"X-Admin-Token": "wrong"})
+
+            assert response.status_code == 403
+
+        def it_keeps_data_when_reset_is_refused(server_process, base_url, clean_database):
+            """Test that a refused reset leaves squirrels in place"""
+            requests.post(f"{base_url}/squirrels", data={"name": "Fluffy", "size": "large"})
+
+            requests.post(f"{base_url}/admin/reset")
+
+            assert len(requests.get(f"{base_url}/squirrels").json()) == 1
+
+    def describe_admission_control():
+        """Test rate limiting and load shedding"""
+
+        def it_admits_requests_within_burst(limited_server_url):
+            """Test that a burst of requests under the limit is served"""
+            responses = [requests.get(f"{limited_server_url}/squirrels") for _ in range(2)]
+
+            assert [response.status_code for response in responses] == [200, 200]
+
+        def it_returns_429_when_client_exceeds_rate(limited_server_url):
+            """Test 429 once the client's burst is used up"""
+            for _ in range(2):
+                requests.get(f"{limited_server_url}/squirrels")
+
+            response = requests.get(f"{limited_server_url}/squirrels")
+
+            assert response.status_code == 429
+            assert response.text == "429 Too Many Requests"
+
+        def it_sends_retry_after_with_429(limited_server_url):
+            """Test Retry-After header on rate-limited responses"""
+            for _ in range(2):
+                requests.get(f"{limited_server_url}/squirrels")
+
+            response = requests.get(f"{limited_server_url}/squirrels")
+
+            assert int(response.headers["Retry-After"]) >= 1
+
+        def it_returns_503_when_too_many_requests_are_in_flight(limited_server_url):
+            """Test 503 with Retry-After when the in-flight cap is reached"""
+            sock = send_stalled_post(limited_server_url)
+            try:
+                response = requests.get(f"{limited_server_url}/squirrels")
+            finally:
+                sock.close()
+
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == "1"
+
+        def it_does_not_charge_a_token_for_a_shed_request(limited_server_url):
+            """Test that a 503 leaves the client's rate limit untouched"""
+            sock = send_stalled_post(limited_server_url)
+            try:
+                shed = requests.get(f"{limited_server_url}/squirrels")
+            finally:
+                sock.close()
+            wait_until(lambda: in_flight(limited_server_url) == 0)
+
+            response = requests.get(f"{limited_server_url}/squirrels")
+
+            assert shed.status_code == 503
+            assert response.status_code == 200
+
+        @pytest.mark.parametrize("option, value", [
+            ("--rate", "-1"),
+            ("--rate", "nan"),
+            ("--burst", "0"),
+            ("--max-in-flight", "-1"),
+            ("--backlog", "0"),
+        ])
+        def it_refuses_to_start_with_invalid_limits(option, value):
+            """Test that out-of-range limits are rejected at startup"""
+            result = subprocess.run(
+                ["python3", "squirrel_server.py", "0", "empty_squirrel_db.db", "--memory", option, value],
+                capture_output=True, text=True, timeout=10
+            )
+
+            assert result.returncode == 2
+            assert option in result.stderr
+
+        def it_answers_admin_stats_while_a_request_is_stalled(limited_server_url):
+            """Test that a stalled POST body doesn't block admin requests"""
+            sock = send_stalled_post(limited_server_url)
+            try:
+                response = requests.get(f"{limited_server_url}/admin/stats", headers={"X-Admin-Token": ADMIN_TOKEN}, timeout=2)
+            finally:
+                sock.close()
+
+            assert response.status_code == 200
+            assert response.json()["inFlight"] == 1
+
+        def it_serves_other_clients_while_a_request_is_stalled(server_process, base_url, clean_database):
+            """Test that a stalled POST body doesn't hold the database"""
+            sock = send_stalled_post(base_url)
+            try:
+                response = requests.get(f"{base_url}/squirrels", timeout=2)
+            finally:
+                sock.close()
+
+            assert response.status_code == 200
+
+        def it_rejects_a_huge_body_without_reading_it(limited_server_url):
+            """Test that a shed request declaring a huge body is answered at once and closed"""
+            for _ in range(2):
+                requests.get(f"{limited_server_url}/squirrels")
+
+            head = send_raw_request(limited_server_url, b"POST /squirrels HTTP/1.1\r\nHost: x\r\nContent-Length: 1000000000\r\n\r\n")
+
+            assert head.startswith("HTTP/1.0 429")
+            assert "Connection: close" in head
+
+        def it_rejects_a_malformed_content_length(limited_server_url):
+            """Test that a shed request with a non-integer Content-Length still gets 429"""
+            for _ in range(2):
+                requests.get(f"{limited_server_url}/squirrels")
+
+            head = send_raw_request(limited_server_url, b"POST /squirrels HTTP/1.1\r\nHost: x\r\nContent-Length: abc\r\n\r\n")
+
+            assert head.startswith("HTTP/1.0 429")
+
+        def it_lets_admin_requests_bypass_limits(limited_server_url):
+            """Test that admin requests are not rate limited"""
+            for _ in range(3):
+                requests.get(f"{limited_server_url}/squirrels")
+
+            response = requests.get(f"{limited_server_url}/admin/stats", headers={"X-Admin-Token": ADMIN_TOKEN})
+
+            assert response.status_code == 200
+
+        def it_reports_limits_and_counters(limited_server_url):
+            """Test GET /admin/stats reports configured limits and outcome counts"""
+            for _ in range(3):
+                requests.get(f"{limited_server_url}/squirrels")
+
+            stats = requests.get(f"{limited_server_url}/admin/stats", headers={"X-Admin-Token": ADMIN_TOKEN}).json()
+
+            assert stats["limits"] == {"rate": 1.0, "burst": 2, "maxInFlight": 1}
+            assert stats["counters"] == {"admitted": 2, "rateLimited": 1, "overloaded": 0}
+
+        def it_returns_403_for_stats_without_admin_token(server_process, base_url, clean_database):
+            """Test 403 for GET /admin/stats without the admin token"""
+            response = requests.get(f"{base_url}/admin/stats")
+
+            assert response.status_code == 403
+
+    def describe_slow_request_log():
+        """Test the slow-request log"""
+
+        def it_logs_route_and_response_size(traced_server):
+            """Test that slow requests are logged with route and body size"""
+            process, url = traced_server
+            requests.get(f"{url}/squirrels")
+
+            stop_server(process)
+
+            assert "slow request: GET /squirrels" in process.stderr.read()
+
+        def it_logs_sql_with_timings(traced_server):
+            """Test that SQL run by SquirrelDB is logged under the request"""
+            process, url = traced_server
+            requests.post(f"{url}/squirrels", data={"name": "Fluffy", "size": "large"})
+
+            stop_server(process)
+
+            log = process.stderr.read()
+            assert "ms INSERT INTO squirrels (name, size) VALUES (?, ?)" in log
+            assert "ms COMMIT" in log
+
+        def it_writes_sql_lines_directly_under_their_request(traced_server):
+            """Test that each request's SQL follows its own summary line"""
+            process, url = traced_server
+            requests.post(f"{url}/squirrels", data={"name": "Fluffy", "size": "large"})
+            requests.get(f"{url}/squirrels")
+
+            stop_server(process)
+
+            lines = process.stderr.read().splitlines()
+            post = next(i for i, line in enumerate(lines) if "slow request: POST /squirrels" in line)
+            get = next(i for i, line in enumerate(lines) if "slow request: GET /squirrels" in line)
+            assert "INSERT INTO squirrels" in lines[post + 1]
+            assert "SELECT * FROM squirrels ORDER BY id" in lines[get + 1]
+
+        def it_reports_response_bytes(traced_server):
+            """Test that the logged size matches the response body"""
+            process, url = traced_server
+            response = requests.get(f"{url}/squirrels/999")
+
+            stop_server(process)
+
+            assert f"ms {len(response.content)} bytes" in process.stderr.read()
+
+    def describe_POST_admin_profile():
+        """Test POST /admin/profile endpoint"""
+
+        def it_starts_a_profile(traced_server):
+            """Test 202 with the output path when a profile starts"""
+            process, url = traced_server
+
+            response = requests.post(f"{url}/admin/profile", data={"seconds": "0.2"}, headers={"X-Admin-Token": ADMIN_TOKEN})
+
+            assert response.status_code == 202
+            assert response.json()["path"].endswith(".folded")
+
+        def it_writes_folded_stacks(traced_server):
+            """Test that the profile is written in collapsed-stack format"""
+            process, url = traced_server
+            response = requests.post(f"{url}/admin/profile", data={"seconds": "0.2"}, headers={"X-Admin-Token": ADMIN_TOKEN})
+
+            path = response.json()["path"]
+            # the profile only appears under its final name once fully written
+            wait_until(lambda: os.path.exists(path))
+
+            with open(path) as f:
+                lines = f.read().splitlines()
+            assert lines
+            assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+        def it_returns_409_while_a_profile_is_running(traced_server):
+            """Test 409 when a profile is already being captured"""
+            process, url = traced_server
+            requests.post(f"{url}/admin/profile", data={"seconds": "1"}, headers={"X-Admin-Token": ADMIN_TOKEN})
+
+            response = requests.post(f"{url}/admin/profile", data={"seconds": "1"}, headers={"X-Admin-Token": ADMIN_TOKEN})
+
+            assert response.status_code == 409
+
+        def it_returns_500_when_the_profile_dir_is_gone(tmp_path):
+            """Test 500 instead of 202 when the profile file can't be created"""
+            profile_dir = tmp_path / "profiles"
+            profile_dir.mkdir()
+            process, port = start_server("--profile-dir", str(profile_dir))
+            try:
+                profile_dir.rmdir()
+                response = requests.post(f"http://127.0.0.1:{port}/admin/profile", data={"seconds": "0.2"}, headers={"X-Admin-Token": ADMIN_TOKEN})
+            finally:
+                stop_server(process)
+
+            assert response.status_code == 500
+
+        def it_refuses_to_start_with_a_missing_profile_dir(tmp_path):
+            """Test that the server exits at startup when --profile-dir doesn't exist"""
+            result = subprocess.run(
+                ["python3", "squirrel_server.py", "0", "empty_squirrel_db.db", "--memory",
+                 "--profile-dir", str(tmp_path / "missing")],
+                capture_output=True, text=True, timeout=10
+            )
+
+            assert result.returncode == 1
+            assert "profile directory not found" in result.stderr
+
+        def it_returns_400_for_invalid_seconds(traced_server):
+            """Test 400 when seconds is not a positive number within the limit"""
+            process, url = traced_server
+
+            response = requests.post(f"{url}/admin/profile", data={"seconds": "-1"}, headers={"X-Admin-Token": ADMIN_TOKEN})
+
+            assert response.status_code == 400
+
+        def it_returns_403_without_admin_token(server_process, base_url, clean_database):
+            """Test 403 for POST /admin/profile without the admin token"""
+            response = requests.post(f"{base_url}/admin/profile")
+
+            assert response.status_code == 403